@@ -3,7 +3,7 @@ from io import StringIO
 import pandas as pd
 import spacy
 from spacy.matcher import PhraseMatcher
-from unidecode import unidecode
+from processing.transliterate import transliterate, map_offsets
 
 def extract_sentence(sentences, row):
     ent_start = row['Start']
@@ -67,8 +67,6 @@ def format_metamap_output_and_generate_labels(input_dir, output_dir, text_dir, b
             # label last paper for BM terms
             if len(papers_analyzed) > 0:
 
-                full_text = unidecode(full_text)
-
                 with open(os.path.join(text_dir, papers_analyzed[-1]), "w") as f:
                     f.write(full_text)
 
@@ -111,7 +109,7 @@ def format_metamap_output_and_generate_labels(input_dir, output_dir, text_dir, b
         info = splits[0].split("\n")
         pmid = ""
         utterance = False
-        start_idx = len(full_text)
+        text = ""
 
         for line in info:
             if "PMID: " in line:
@@ -125,14 +123,19 @@ def format_metamap_output_and_generate_labels(input_dir, output_dir, text_dir, b
                     pmid = pmid_found
 
             if utterance:
-                full_text = full_text + line
+                text = text + line
 
             if "UttText:" in line:
                 utterance = True
             else:
                 utterance = False
 
-        full_text = full_text + " "
+        text = text + " "
+
+        # MetaMap offsets are relative to the original text, so keep a map to the transliterated text
+        start_idx = len(full_text)
+        text, offset_map = transliterate(text)
+        full_text = full_text + text
 
         # no terms detected
         if len(splits) < 2:
@@ -144,8 +147,8 @@ def format_metamap_output_and_generate_labels(input_dir, output_dir, text_dir, b
         temp.columns = metamap_columns
         temp["paper"] = paper
         temp = temp.rename(columns={"StartPos": "Start", "CandidateCUI":"CUI"})
-        temp["Start"] = temp["Start"] + start_idx
-        temp["End"] = temp["Start"] + temp["Length"]
+        temp["End"] = map_offsets(offset_map, temp["Start"] + temp["Length"], start_idx)
+        temp["Start"] = map_offsets(offset_map, temp["Start"], start_idx)
         temp["Entity"] = temp.apply(lambda row: full_text[row['Start']:row['End']].strip(), axis=1)
         temp["Sentence_pred"] = temp.apply(lambda row: extract_sentence(doc.sents, row), axis=1)
         temp = temp[['Start', 'End', 'CUI', 'Entity', 'paper', 'Sentence_pred', 'SemType']] # these are the only columns needed
@@ -155,8 +158,6 @@ def format_metamap_output_and_generate_labels(input_dir, output_dir, text_dir, b
 
 
         # analyze previous paper
-        full_text = unidecode(full_text)
-
         with open(os.path.join(text_dir, papers_analyzed[-1]), "w") as f:
             f.write(full_text)
 
@@ -184,7 +185,7 @@ def format_metamap_output_and_generate_labels(input_dir, output_dir, text_dir, b
             paper = filename.split("_")[0]
             with open(os.path.join(metamap_add, filename)) as f:
                 full_text = f.read()
-            full_text = unidecode(full_text)
+            full_text, _ = transliterate(full_text)
 
             doc = nlp(full_text)
             matches = matcher(doc)
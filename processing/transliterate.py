@@ -0,0 +1,21 @@
+import numpy as np
+from unidecode import unidecode
+
+def transliterate(text):
+    # transliterate text to ASCII with unidecode, one character at a time so that offset_map[i] is the
+    # offset in the new text of character i in the original text (offset_map[len(text)] == len(new text))
+    if text.isascii():
+        return text, np.arange(len(text) + 1, dtype=np.int32)
+
+    pieces = [c if c.isascii() else unidecode(c) for c in text]
+    offset_map = np.zeros(len(text) + 1, dtype=np.int32)
+    np.cumsum(np.fromiter((len(p) for p in pieces), dtype=np.int32, count=len(pieces)), out=offset_map[1:])
+    return "".join(pieces), offset_map
+
+
+def map_offsets(offset_map, offsets, shift=0):
+    # map offsets in the original text to offsets in the transliterated text, then add shift
+    # (offsets past the end of the text keep their distance from the end)
+    offsets = np.asarray(offsets)
+    end = len(offset_map) - 1
+    return offset_map[np.minimum(offsets, end)] + np.maximum(offsets - end, 0) + shift
@@ -1,16 +1,18 @@
-import argparse, os, sys
+import argparse, os, sys, tempfile
+from collections import Counter
 import pandas as pd
 from datetime import datetime
 
 # function for filtering predictions
-def filter_pred(pred_df_temp, filter_out_file=None, filter_tuis=None, clamp_problem=False):
+def filter_pred(pred_df_temp, filter_out_file=None, filter_tuis=None, clamp_problem=False, autism_comorbid=None):
     
     pred_df_temp = pred_df_temp.dropna(subset=["CUI"]) # keep only terms with CUI
     pred_df_temp = pred_df_temp[(pred_df_temp["CUI"].str.len() == 8) & (pred_df_temp["CUI"].str[0] == 'C')] # valid CUI only
     pred_df_temp =  pred_df_temp[(pred_df_temp["TUI"].isin(filter_tuis)) | (pred_df_temp["CUI"]=='C0018817')] # C0018817 is atrial septal defect
     
-    # remove non-ASD specific terms (i.e. commorbidities)
-    autism_comorbid = set(pd.read_csv(filter_out_file)["CUI"])
+    # remove non-ASD specific terms (i.e. commorbidities), pass autism_comorbid to avoid re-reading filter_out_file
+    if autism_comorbid is None:
+        autism_comorbid = set(pd.read_csv(filter_out_file)["CUI"])
     pred_df_temp = pred_df_temp[~(pred_df_temp["CUI"].isin(autism_comorbid))]
 
     # only keep CLAMP predictions with a Semantic of 'problem'
@@ -21,7 +23,7 @@ def filter_pred(pred_df_temp, filter_out_file=None, filter_tuis=None, clamp_prob
     return pred_df
 
 
-def calculate_statistics(pred_df, true_df):
+def match_predictions(pred_df, true_df):
     # drop duplicate predictions on same entity span
     pred_df = pred_df.drop_duplicates(subset=["paper", "Start", "End"]).sort_values(by=["paper", "Start", "End"])
     true_df = true_df.drop_duplicates(subset=["paper", "Start", "End"]).sort_values(by=["paper", "Start", "End"])
@@ -59,10 +61,18 @@ def calculate_statistics(pred_df, true_df):
     temp = match_grouped[(match_grouped["Start_pred"] != "NA") & (match_grouped["Start_label"] != "NA")]
     temp = temp[((temp["Start_pred"] >= temp["Start_label"]) & (temp["Start_pred"] <= temp["End_label"])) | ((temp["Start_label"] >= temp["Start_pred"]) & (temp["Start_label"] <= temp["End_pred"]))]   
     true_pos_df = temp
-    num_true_pos = len(temp.drop_duplicates(["paper", "Start_label", "End_label"])) # only count max one pred per label
+
+    return true_pos_df, pred_df, true_df
+
+
+def count_positives(true_pos_df, pred_df, true_df):
+    num_true_pos = len(true_pos_df.drop_duplicates(["paper", "Start_label", "End_label"])) # only count max one pred per label
     num_label_pos = len(true_df)
     num_pred_pos = len(pred_df)
+    return num_true_pos, num_label_pos, num_pred_pos
+
 
+def print_statistics(num_true_pos, num_label_pos, num_pred_pos):
     print("Number of true positives =", num_true_pos)
     print("Number of positive labels =", num_label_pos)
     print("Number of positive predictions =", num_pred_pos)
@@ -72,7 +82,11 @@ def calculate_statistics(pred_df, true_df):
     print("Precision =", precision)
     print("Recall =", recall)
     print("F-Measure =", (2 * precision * recall) / (precision + recall))
-    
+
+
+def calculate_statistics(pred_df, true_df):
+    true_pos_df, pred_df, true_df = match_predictions(pred_df, true_df)
+    print_statistics(*count_positives(true_pos_df, pred_df, true_df))
     return true_pos_df, pred_df, true_df
 
 
@@ -107,6 +121,142 @@ def get_false_and_true_pos(true_pos_df, pred_df, true_df):
     return true_pos_grouped, false_pos_grouped, false_neg_grouped, false_pos, false_neg
 
 
+# column dtypes taken from the first chunk of a csv, used for every chunk and partition so they can't differ between them
+# (paper, CUI, TUI, Entity*, text columns and columns that are empty in the first chunk are read as str)
+def stream_dtypes(path, chunksize):
+    first = pd.read_csv(path, nrows=chunksize, dtype={"paper": str})
+    dtypes = first.dtypes.to_dict()
+    for column in first.columns:
+        if column in ["paper", "CUI", "TUI"] or column.startswith("Entity") or first[column].isnull().all() or not pd.api.types.is_numeric_dtype(first[column]):
+            dtypes[column] = str
+    return dtypes
+
+
+# yield (paper, rows) from a csv grouped by paper in ascending order, holding at most one paper (plus one chunk) in memory
+def iter_papers(path, chunksize, dtypes):
+    carry = None
+    last_paper = None
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype=dtypes):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        chunk = chunk[~(chunk["paper"].isnull())]
+        if len(chunk) == 0:
+            continue
+        # last paper in the chunk may continue in the next chunk
+        tail = chunk["paper"].iloc[-1]
+        carry = chunk[chunk["paper"] == tail]
+        for paper, group in chunk[chunk["paper"] != tail].groupby("paper", sort=False):
+            if last_paper is not None and paper <= last_paper:
+                raise Exception(f"{path} is not sorted by paper:", paper)
+            last_paper = paper
+            yield paper, group
+    if carry is not None and len(carry) > 0:
+        paper = carry["paper"].iloc[0]
+        if last_paper is not None and paper <= last_paper:
+            raise Exception(f"{path} is not sorted by paper:", paper)
+        yield paper, carry
+
+
+# empty frame with the columns and dtypes of a csv (stands in for a paper missing from that csv)
+def empty_partition(path, dtypes):
+    return pd.read_csv(path, nrows=0, dtype=dtypes)
+
+
+# merge-join two csvs sorted by paper and yield (pred_df, true_df) one paper at a time
+def iter_sorted_partitions(pred_path, labels_path, chunksize):
+    pred_dtypes = stream_dtypes(pred_path, chunksize)
+    true_dtypes = stream_dtypes(labels_path, chunksize)
+    pred_empty = empty_partition(pred_path, pred_dtypes)
+    true_empty = empty_partition(labels_path, true_dtypes)
+    preds = iter_papers(pred_path, chunksize, pred_dtypes)
+    labels = iter_papers(labels_path, chunksize, true_dtypes)
+    pred = next(preds, None)
+    label = next(labels, None)
+    while pred is not None or label is not None:
+        if label is None or (pred is not None and pred[0] < label[0]):
+            yield pred[1], true_empty
+            pred = next(preds, None)
+        elif pred is None or label[0] < pred[0]:
+            yield pred_empty, label[1]
+            label = next(labels, None)
+        else:
+            yield pred[1], label[1]
+            pred = next(preds, None)
+            label = next(labels, None)
+
+
+# split a csv into partition files by a hash of paper (overlaps never cross papers)
+def partition_by_paper(path, partition_dir, name, num_partitions, chunksize, dtypes):
+    written = set()
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype=dtypes):
+        chunk = chunk[~(chunk["paper"].isnull())]
+        partition = pd.util.hash_pandas_object(chunk["paper"], index=False) % num_partitions
+        for i, group in chunk.groupby(partition.values):
+            group.to_csv(os.path.join(partition_dir, f"{name}_{i}.csv"), mode="a", header=i not in written, index=False)
+            written.add(i)
+    return written
+
+
+# hash-partition both csvs by paper and yield (pred_df, true_df) one partition at a time
+# (memory is bounded by the largest partition, not the largest paper)
+def iter_hashed_partitions(pred_path, labels_path, chunksize, num_partitions):
+    pred_dtypes = stream_dtypes(pred_path, chunksize)
+    true_dtypes = stream_dtypes(labels_path, chunksize)
+    pred_empty = empty_partition(pred_path, pred_dtypes)
+    true_empty = empty_partition(labels_path, true_dtypes)
+    with tempfile.TemporaryDirectory() as partition_dir:
+        pred_written = partition_by_paper(pred_path, partition_dir, "preds", num_partitions, chunksize, pred_dtypes)
+        true_written = partition_by_paper(labels_path, partition_dir, "labels", num_partitions, chunksize, true_dtypes)
+        for i in sorted(pred_written | true_written):
+            pred_df = pd.read_csv(os.path.join(partition_dir, f"preds_{i}.csv"), dtype=pred_dtypes) if i in pred_written else pred_empty
+            true_df = pd.read_csv(os.path.join(partition_dir, f"labels_{i}.csv"), dtype=true_dtypes) if i in true_written else true_empty
+            yield pred_df, true_df
+
+
+def append_csv(df, path, written):
+    df.to_csv(path, mode="a" if path in written else "w", header=path not in written, index=False)
+    written.add(path)
+
+
+# evaluate (pred_df, true_df) partitions one at a time, accumulating counts and appending the per-prediction
+# exports to true_pos_path and false_pos_path, so memory is bounded by the largest partition
+def calculate_statistics_streaming(partitions, true_pos_path, false_pos_path):
+    num_true_pos = num_label_pos = num_pred_pos = 0
+    true_pos_counts = Counter()
+    false_pos_counts = Counter()
+    false_neg_counts = Counter()
+    written = set()
+    for pred_df, true_df in partitions:
+        true_pos_df, pred_df_temp, true_df_temp = match_predictions(pred_df, true_df)
+        n_true_pos, n_label_pos, n_pred_pos = count_positives(true_pos_df, pred_df_temp, true_df_temp)
+        num_true_pos += n_true_pos
+        num_label_pos += n_label_pos
+        num_pred_pos += n_pred_pos
+
+        true_pos_grouped, false_pos_grouped, false_neg_grouped, false_pos, _ = get_false_and_true_pos(true_pos_df, pred_df, true_df)
+        true_pos_counts.update(dict(zip(zip(true_pos_grouped["Entity_label"], true_pos_grouped["Entity_pred"]), true_pos_grouped["Entity_pred count"])))
+        false_pos_counts.update(dict(zip(zip(false_pos_grouped["Entity"], false_pos_grouped["CUI"], false_pos_grouped["TUI"]), false_pos_grouped["count"])))
+        false_neg_counts.update(dict(zip(zip(false_neg_grouped["Entity"], false_neg_grouped["CUI"], false_neg_grouped["TUI"]), false_neg_grouped["count"])))
+
+        if len(true_pos_df) > 0 or true_pos_path not in written:
+            append_csv(true_pos_df, true_pos_path, written)
+        if len(false_pos) > 0 or false_pos_path not in written:
+            append_csv(false_pos, false_pos_path, written)
+
+    # build the grouped tables in the same format as get_false_and_true_pos
+    temp = pd.DataFrame([(label, pred, count) for (label, pred), count in true_pos_counts.items()], columns=["Entity_label", "Entity_pred", "Entity_pred count"])
+    temp["Entity_label count"] = temp.groupby(by=["Entity_label"])["Entity_pred count"].transform("sum")
+    true_pos_grouped = temp.sort_values(by=["Entity_label count", "Entity_pred count"], ascending=False)
+
+    columns = ["Entity", "CUI", "TUI"]
+    false_pos_grouped = pd.DataFrame([key + (count,) for key, count in false_pos_counts.items()], columns=columns + ["count"])
+    false_pos_grouped = false_pos_grouped.sort_values(by="count", ascending=False).reset_index(drop=True)
+    false_neg_grouped = pd.DataFrame([key + (count,) for key, count in false_neg_counts.items()], columns=columns + ["count"])
+    false_neg_grouped = false_neg_grouped.sort_values(by="count", ascending=False).reset_index(drop=True)
+
+    return (num_true_pos, num_label_pos, num_pred_pos), true_pos_grouped, false_pos_grouped, false_neg_grouped
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Get the NER results for CLAMP, cTAKES, or MetaMap.')
     parser.add_argument('tool', help='Either CLAMP, cTAKES, or MetaMap.')
@@ -116,6 +266,10 @@ if __name__ == "__main__":
     parser.add_argument('output_dir', help='The path to the directory where the true positive, false positive, and false negative preidctions will be outputted.')
     parser.add_argument('-f', '--filter', action='store_true', help='Use -f --filter flag to turn on filtering of the predictions.')
     parser.add_argument('-r', '--remove', help='The path to the file containing CUI to filter out from the predictions when the -f --filter flag i used.')
+    parser.add_argument('-s', '--stream', action='store_true', help='Use -s --stream flag to evaluate the predictions and labels in partitions by paper instead of loading them into memory at once. Rows without a paper are skipped.')
+    parser.add_argument('--presorted', action='store_true', help='Use with -s --stream when both files are already sorted by paper (as text), so they are evaluated one paper at a time and memory is bounded by the largest paper.')
+    parser.add_argument('-c', '--chunksize', type=int, default=100000, help='Number of rows read at a time when using the -s --stream flag.')
+    parser.add_argument('-n', '--num-partitions', type=int, default=256, help='Number of partitions by paper when using the -s --stream flag without --presorted. Memory is bounded by the largest partition (about 1/num-partitions of the input), not the largest paper.')
     args = parser.parse_args()
 
     # for naming files
@@ -132,31 +286,59 @@ if __name__ == "__main__":
     now = datetime.now()
     current_time = now.strftime("%H:%M:%S")
     print("Start time =", current_time)
-    labels_df = pd.read_csv(args.labels)
-    pred_df = pd.read_csv(args.input)
-    if args.filter:
-        pred_df = filter_pred(pred_df, filter_out_file=args.remove, filter_tuis=['T033', 'T048'], clamp_problem=False)
 
     original_stdout = sys.stdout
-    # calculate NER results and save to file
-    with open(args.output, "w") as f:
-        sys.stdout = f 
-        print(f"{tool} results")
-        true_pos_df, pred_df_temp, labels_df_temp = calculate_statistics(pred_df, labels_df)
-        sys.stdout = original_stdout 
-        
-    with open(args.output, "r") as f:
-        print(f.read())
+    if args.stream:
+        if args.presorted:
+            partitions = iter_sorted_partitions(args.input, args.labels, args.chunksize)
+        else:
+            partitions = iter_hashed_partitions(args.input, args.labels, args.chunksize, args.num_partitions)
+        if args.filter:
+            autism_comorbid = set(pd.read_csv(args.remove)["CUI"])
+            partitions = ((filter_pred(pred_df, filter_tuis=['T033', 'T048'], clamp_problem=False, autism_comorbid=autism_comorbid), labels_df) for pred_df, labels_df in partitions)
+
+        # calculate NER results, exporting all true positives and false positives as they are found
+        counts, true_pos_grouped, false_pos_grouped, false_neg_grouped = calculate_statistics_streaming(partitions,
+            os.path.join(args.output_dir, filtered + f"{tool}_true_positive_all.csv"),
+            os.path.join(args.output_dir, filtered + f"{tool}_false_positive_all.csv"))
+
+        with open(args.output, "w") as f:
+            sys.stdout = f
+            print(f"{tool} results")
+            print_statistics(*counts)
+            sys.stdout = original_stdout
+
+        with open(args.output, "r") as f:
+            print(f.read())
+
+        true_pos_grouped.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_true_positive.csv"), index=False)
+        false_pos_grouped.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_false_positive.csv"), index=False)
+        false_neg_grouped.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_false_negative.csv"), index=False)
+
+    else:
+        labels_df = pd.read_csv(args.labels)
+        pred_df = pd.read_csv(args.input)
+        if args.filter:
+            pred_df = filter_pred(pred_df, filter_out_file=args.remove, filter_tuis=['T033', 'T048'], clamp_problem=False)
+
+        # calculate NER results and save to file
+        with open(args.output, "w") as f:
+            sys.stdout = f 
+            print(f"{tool} results")
+            true_pos_df, pred_df_temp, labels_df_temp = calculate_statistics(pred_df, labels_df)
+            sys.stdout = original_stdout 
+            
+        with open(args.output, "r") as f:
+            print(f.read())
 
-    # get true positives, false positives, false negatives and export
-    true_pos_grouped, false_pos_grouped, false_neg_grouped, false_pos, false_neg = get_false_and_true_pos(true_pos_df, pred_df, labels_df)
-    true_pos_grouped.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_true_positive.csv"), index=False)
-    false_pos_grouped.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_false_positive.csv"), index=False)
-    false_neg_grouped.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_false_negative.csv"), index=False)
-    false_pos.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_false_positive_all.csv"), index=False)
-    true_pos_df.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_true_positive_all.csv"), index=False)
+        # get true positives, false positives, false negatives and export
+        true_pos_grouped, false_pos_grouped, false_neg_grouped, false_pos, false_neg = get_false_and_true_pos(true_pos_df, pred_df, labels_df)
+        true_pos_grouped.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_true_positive.csv"), index=False)
+        false_pos_grouped.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_false_positive.csv"), index=False)
+        false_neg_grouped.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_false_negative.csv"), index=False)
+        false_pos.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_false_positive_all.csv"), index=False)
+        true_pos_df.to_csv(os.path.join(args.output_dir, filtered + f"{tool}_true_positive_all.csv"), index=False)
 
     now = datetime.now()
     current_time = now.strftime("%H:%M:%S")
     print("End time =", current_time)
-    
\ No newline at end of file